@@ -5,16 +5,18 @@ import requests
 import base64
 import json
 from datetime import datetime, timedelta
-from fastapi import FastAPI, Request
-from fastapi.responses import PlainTextResponse, Response
+from fastapi import FastAPI, Request, Query
+from fastapi.responses import PlainTextResponse, Response, JSONResponse
 from twilio.twiml.messaging_response import MessagingResponse
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 import dateparser
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
 from teams_integration import ms_login, ms_callback, create_teams_meeting, get_token, normalize_user_id
 from twilio.rest import Client
 from birthday_reminders import start_birthday_scheduler
+from audit_log import log_event, now_ms, start_audit_logger, stop_audit_logger, get_funnel_stats, get_latency_stats, get_audit_status
 import pandas as pd
 
 app = FastAPI()
@@ -214,6 +216,7 @@ def handle_meeting_flow(user_id, message):
         # Step 1 → Topic
         if step == "topic":
             save_user_session(user_id, {**session, "step": "time", "topic": message})
+            log_event("topic_received", user_id, platform=platform)
             return "📅 Great! When should the meeting start? (e.g. 'tomorrow 3pm')"
 
         # Step 2 → Time
@@ -225,6 +228,7 @@ def handle_meeting_flow(user_id, message):
                 user_id,
                 {**session, "step": "duration", "start_time": start_time.strftime("%Y-%m-%dT%H:%M:%SZ")}
             )
+            log_event("time_received", user_id, platform=platform)
             return "⏱️ Got it! How long should the meeting last (in minutes)?"
 
         # Step 3 → Duration
@@ -237,15 +241,23 @@ def handle_meeting_flow(user_id, message):
             topic = session["topic"]
             start_time = session["start_time"]
 
-            if platform == "zoom":
-                meeting_link = create_zoom_meeting(topic, start_time, duration)
-            elif platform == "google":
-                meeting_link = create_google_meet(topic, start_time, duration)
-            elif platform == "teams":
-                meeting_link = create_teams_meeting(user_id, topic, start_time, duration)
-            else:
-                meeting_link = None
-
+            started = now_ms()
+            try:
+                if platform == "zoom":
+                    meeting_link = create_zoom_meeting(topic, start_time, duration)
+                elif platform == "google":
+                    meeting_link = create_google_meet(topic, start_time, duration)
+                elif platform == "teams":
+                    meeting_link = create_teams_meeting(user_id, topic, start_time, duration)
+                else:
+                    meeting_link = None
+            except Exception as e:
+                log_event("meeting_failed", user_id, platform=platform,
+                          latency_ms=round(now_ms() - started), error=str(e)[:200])
+                raise
+
+            log_event("meeting_created", user_id, platform=platform,
+                      latency_ms=round(now_ms() - started), duration=duration)
             delete_user_session(user_id)
             return f"✅ Meeting created!\n🔗 {meeting_link}"
 
@@ -256,12 +268,15 @@ def handle_meeting_flow(user_id, message):
     print(f"🆕 New session started for {user_id}")  # DEBUG
     if "zoom" in msg:
         save_user_session(user_id, {"platform": "zoom", "step": "topic"})
+        log_event("flow_started", user_id, platform="zoom")
         return "✅ Creating a Zoom meeting! What’s the topic?"
     elif "google" in msg:
         save_user_session(user_id, {"platform": "google", "step": "topic"})
+        log_event("flow_started", user_id, platform="google")
         return "✅ Creating a Google Meet! What’s the topic?"
     elif "teams" in msg:
         token = get_token(user_id)
+        log_event("flow_started", user_id, platform="teams", logged_in=bool(token))
         if not token:
             save_user_session(user_id, {"platform": "teams", "step": "topic"})
             login_url = f"https://whatsappbot-f8mu.onrender.com/ms/login?user_id={user_id}"
@@ -287,6 +302,8 @@ async def whatsapp_webhook(request: Request):
     print(f"📩 Incoming from {from_number}: {incoming_msg}")  # DEBUG
 
     resp = MessagingResponse()
+    started = now_ms()
+    ok = True
     try:
         reply = handle_meeting_flow(from_number, incoming_msg)
         if not reply:
@@ -296,18 +313,41 @@ async def whatsapp_webhook(request: Request):
         resp.message(reply)
 
     except Exception as e:
+        ok = False
         print(f"⚠️ Error: {e}")  # Debug log
         resp.message(f"❌ Error: {str(e)}")
 
+    log_event("webhook_handled", normalize_user_id(from_number), ok=ok, latency_ms=round(now_ms() - started))
+
     return Response(content=resp.to_xml(), media_type="application/xml")
 
+# ------------------- ANALYTICS -------------------
+@app.get("/analytics")
+def analytics(hours: float | None = Query(None, gt=0, le=24 * 365)):
+    # Plain def: the aggregations block, so FastAPI runs this in its threadpool.
+    since = datetime.utcnow() - timedelta(hours=hours) if hours else None
+    try:
+        return {
+            "funnel": get_funnel_stats(since),
+            "latency": get_latency_stats(since),
+            "buffer": get_audit_status(),
+        }
+    except PyMongoError as e:
+        print(f"❌ Analytics query failed: {e}")
+        return JSONResponse(status_code=503, content={"error": str(e), "buffer": get_audit_status()})
+
 # ------------------- STARTUP EVENT -------------------
 @app.on_event("startup")
 def on_startup():
+    start_audit_logger()
     import_birthdays_from_excel("employees_birthdays.xlsx")
     start_birthday_scheduler(twilio_client, TWILIO_PHONE, DEFAULT_RECIPIENT_PHONE)
     print("✅ Startup tasks completed")
 
+@app.on_event("shutdown")
+def on_shutdown():
+    stop_audit_logger()
+
 # ------------------- START SERVER -------------------
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,219 @@
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from pymongo import MongoClient, errors
+
+# ------------------- Environment Variables -------------------
+MONGO_URL = os.getenv("MONGO_URL")
+
+AUDIT_COLLECTION = os.getenv("AUDIT_COLLECTION", "audit_events")
+AUDIT_CAPPED_SIZE_BYTES = int(os.getenv("AUDIT_CAPPED_SIZE_BYTES", str(50 * 1024 * 1024)))  # 50 MB
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "100"))           # flush when this many events are buffered
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "5"))   # ...or every N seconds
+AUDIT_MAX_BUFFER = int(os.getenv("AUDIT_MAX_BUFFER", "5000"))          # oldest events are dropped beyond this
+
+# ------------------- MongoDB Setup -------------------
+mongo_client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=5000, socketTimeoutMS=10000)
+db = mongo_client.whatsappbot
+events_collection = db[AUDIT_COLLECTION]
+
+# ------------------- Buffer -------------------
+# Events live in memory until the flusher thread writes them with insert_many,
+# at most AUDIT_BATCH_SIZE per insert. If Mongo is unreachable the chunk goes
+# back to the front of the buffer, so during an outage events are only lost
+# through AUDIT_MAX_BUFFER eviction. Chunks Mongo rejects (auth, invalid
+# documents) are dropped instead of retried. Both are counted in _dropped.
+# A hard kill loses at most AUDIT_MAX_BUFFER buffered events plus the one
+# chunk being inserted.
+_buffer = deque(maxlen=AUDIT_MAX_BUFFER)
+_lock = threading.Lock()
+_flush_lock = threading.Lock()  # one flush at a time (flusher thread vs. shutdown)
+_wakeup = threading.Event()
+_stop = threading.Event()
+_flusher = None
+_dropped = 0
+
+
+def log_event(event, user_id=None, **fields):
+    """Queue an analytics event. Never touches Mongo on the request path."""
+    global _dropped
+    doc = {"event": event, "user_id": user_id, "ts": datetime.utcnow(), **fields}
+    with _lock:
+        if len(_buffer) == _buffer.maxlen:
+            _dropped += 1
+        _buffer.append(doc)
+        pending = len(_buffer)
+    if pending >= AUDIT_BATCH_SIZE:
+        _wakeup.set()
+
+
+def _requeue(batch):
+    """Put a failed chunk back at the front, counting anything evicted by maxlen."""
+    global _dropped
+    with _lock:
+        overflow = len(_buffer) + len(batch) - _buffer.maxlen
+        if overflow > 0:
+            _dropped += overflow
+        _buffer.extendleft(reversed(batch))
+
+
+def _drop(count):
+    global _dropped
+    with _lock:
+        _dropped += count
+
+
+def flush_events():
+    """Drain the buffer in insert_many chunks. Returns False if a chunk failed."""
+    with _flush_lock:
+        while True:
+            with _lock:
+                if not _buffer:
+                    return True
+                batch = [_buffer.popleft() for _ in range(min(AUDIT_BATCH_SIZE, len(_buffer)))]
+            try:
+                events_collection.insert_many(batch, ordered=False)
+            except errors.BulkWriteError as e:
+                # Unordered insert: the rest of the chunk was written, the failed
+                # documents were rejected by the server and retrying won't help.
+                rejected = len(batch) - e.details.get("nInserted", 0)
+                _drop(rejected)
+                print(f"❌ {rejected} of {len(batch)} audit events rejected: {e}")
+                return False
+            except errors.ConnectionFailure as e:
+                # Covers AutoReconnect, NotPrimaryError and timeouts: Mongo may come back.
+                _requeue(batch)
+                print(f"❌ Failed to flush {len(batch)} audit events, kept for retry: {e}")
+                return False
+            except Exception as e:
+                # Auth failures, InvalidDocument etc. will fail the same way next time.
+                _drop(len(batch))
+                print(f"❌ Dropped {len(batch)} audit events that Mongo won't accept: {e}")
+                return False
+
+
+def _flush_loop():
+    backoff = False
+    while not _stop.is_set():
+        if backoff:
+            # After a failure wait a full interval, ignoring batch-size wakeups.
+            _stop.wait(AUDIT_FLUSH_INTERVAL)
+        else:
+            _wakeup.wait(AUDIT_FLUSH_INTERVAL)
+        _wakeup.clear()
+        backoff = not flush_events()
+
+
+def _ensure_collection():
+    try:
+        if AUDIT_COLLECTION not in db.list_collection_names():
+            db.create_collection(AUDIT_COLLECTION, capped=True, size=AUDIT_CAPPED_SIZE_BYTES)
+            print(f"✅ Created capped collection {AUDIT_COLLECTION} ({AUDIT_CAPPED_SIZE_BYTES} bytes)")
+    except errors.CollectionInvalid:
+        pass  # created concurrently by another worker
+    except Exception as e:
+        print(f"⚠️ Could not prepare audit collection {AUDIT_COLLECTION}: {e}")
+        return
+    try:
+        events_collection.create_index([("ts", 1), ("event", 1)])
+    except Exception as e:
+        print(f"⚠️ Could not prepare audit collection {AUDIT_COLLECTION}: {e}")
+
+
+def start_audit_logger():
+    global _flusher
+    if _flusher is not None and _flusher.is_alive():
+        return
+    _ensure_collection()
+    _stop.clear()
+    _flusher = threading.Thread(target=_flush_loop, name="audit-flusher", daemon=True)
+    _flusher.start()
+    print("📊 Audit logger started!")
+
+
+def stop_audit_logger(timeout=5):
+    """Stop the flusher and write whatever is still buffered."""
+    _stop.set()
+    _wakeup.set()
+    if _flusher is not None:
+        _flusher.join(timeout)
+    # If the flusher is still inside insert_many, _flush_lock makes this wait
+    # for it (bounded by socketTimeoutMS) so a requeued chunk isn't stranded.
+    flush_events()
+    status = get_audit_status()
+    print(f"📊 Audit logger stopped, {status['pending']} events unflushed, dropped {status['dropped']} so far")
+
+
+# ------------------- Aggregations -------------------
+FUNNEL_STEPS = ["flow_started", "topic_received", "time_received", "meeting_created"]
+
+
+def get_funnel_stats(since=None):
+    match = {"event": {"$in": FUNNEL_STEPS + ["meeting_failed"]}}
+    if since:
+        match["ts"] = {"$gte": since}
+
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {"event": "$event", "platform": "$platform", "user_id": "$user_id"},
+            "count": {"$sum": 1},
+        }},
+        {"$group": {
+            "_id": {"event": "$_id.event", "platform": "$_id.platform"},
+            "count": {"$sum": "$count"},
+            "users": {"$sum": 1},
+        }},
+    ]
+
+    platforms = {}
+    for row in events_collection.aggregate(pipeline):
+        platform = row["_id"].get("platform") or "unknown"
+        stats = platforms.setdefault(platform, {step: {"events": 0, "users": 0} for step in FUNNEL_STEPS + ["meeting_failed"]})
+        stats[row["_id"]["event"]] = {"events": row["count"], "users": row["users"]}
+    return platforms
+
+
+def get_latency_stats(since=None):
+    match = {"event": {"$in": ["meeting_created", "meeting_failed", "webhook_handled"]}, "latency_ms": {"$exists": True}}
+    if since:
+        match["ts"] = {"$gte": since}
+
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {"event": "$event", "platform": "$platform"},
+            "count": {"$sum": 1},
+            "avg_ms": {"$avg": "$latency_ms"},
+            "min_ms": {"$min": "$latency_ms"},
+            "max_ms": {"$max": "$latency_ms"},
+        }},
+    ]
+
+    stats = []
+    for row in events_collection.aggregate(pipeline):
+        stats.append({
+            "event": row["_id"]["event"],
+            "platform": row["_id"].get("platform"),
+            "count": row["count"],
+            "avg_ms": round(row["avg_ms"], 1),
+            "min_ms": row["min_ms"],
+            "max_ms": row["max_ms"],
+        })
+    return stats
+
+
+def get_audit_status():
+    with _lock:
+        pending = len(_buffer)
+    return {
+        "pending": pending,
+        "dropped": _dropped,
+        "flusher_alive": _flusher is not None and _flusher.is_alive(),
+    }
+
+
+def now_ms():
+    return time.monotonic() * 1000